@@ -3,7 +3,7 @@ from pathlib import Path
 from urllib.parse import urlparse
 
 from cmd2 import ansi
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, joinedload
 from sqlalchemy import exc, or_, create_engine
 from sqlalchemy.sql.expression import ClauseElement
 
@@ -24,12 +24,17 @@ class DBManager:
 
     def __init__(self, db_location):
         self.location = Path(db_location).expanduser().resolve()
-        self.connection_string = f"sqlite:///{self.location}"
+        self.connection_string = self.get_connection_string(self.location)
         engine = create_engine(self.connection_string)
         Base.metadata.create_all(engine)  # noqa: F405
         session_factory = sessionmaker(bind=engine)
         self.session = session_factory()
 
+    @staticmethod
+    def get_connection_string(db_location):
+        """ Simple helper to build the connection string for a database location without connecting to it """
+        return f"sqlite:///{Path(db_location).expanduser().resolve()}"
+
     def get_or_create(self, model, **kwargs):
         """ Simple helper to either get an existing record if it exists otherwise create and return a new instance """
         instance = self.session.query(model).filter_by(**kwargs).first()
@@ -40,10 +45,16 @@ class DBManager:
             instance = model(**params)
             return instance
 
-    def add(self, item):
-        """ Simple helper to add a record to the database """
+    def add(self, item, commit=True):
+        """ Simple helper to add a record to the database; pass commit=False to batch several adds into one commit """
+        self.session.add(item)
+
+        if commit:
+            self.commit()
+
+    def commit(self):
+        """ Simple helper to commit all pending records to the database """
         try:
-            self.session.add(item)
             self.session.commit()
         except (sqlite3.IntegrityError, exc.IntegrityError):
             print(ansi.style(f"[-] unique key constraint handled, moving on...", fg="bright_white"))
@@ -96,6 +107,17 @@ class DBManager:
             x[0] for x in self.session.query(IPAddress.ipv6_address).filter(IPAddress.ipv6_address != None)
         ]  # noqa: E711
 
+    def get_ip_addresses_by_address(self) -> dict:
+        """ Simple helper that returns a dict of every ipv4/6 address string mapped to its IPAddress record """
+        ip_addresses = dict()
+
+        for ip_address in self.session.query(IPAddress).options(joinedload(IPAddress.target)):
+            for address in (ip_address.ipv4_address, ip_address.ipv6_address):
+                if address is not None:
+                    ip_addresses[address] = ip_address
+
+        return ip_addresses
+
     def close(self):
         """ Simple helper to close the database session """
         self.session.close()
@@ -130,14 +152,21 @@ class DBManager:
         return endpoints
 
     def get_nmap_scans_by_ip_or_hostname(self, ip_or_host):
-        """ Simple helper that returns all Endpoints filtered by ip or hostname """
-        scans = list()
-
-        for result in self.session.query(NmapResult).filter(NmapResult.commandline.contains(ip_or_host)).all():
-            if result.commandline.split()[-1] == ip_or_host:
-                scans.append(result)
-
-        return scans
+        """ Simple helper that returns all NmapResults filtered by ip or hostname """
+        # filter on the structured ip address/target columns instead of pattern matching the nmap commandline text
+        return (
+            self.session.query(NmapResult)
+            .outerjoin(NmapResult.ip_address)
+            .outerjoin(NmapResult.target)
+            .filter(
+                or_(
+                    IPAddress.ipv4_address == ip_or_host,
+                    IPAddress.ipv6_address == ip_or_host,
+                    Target.hostname == ip_or_host,
+                )
+            )
+            .all()
+        )
 
     def get_status_codes(self):
         """ Simple helper that returns all status codes found during scanning """
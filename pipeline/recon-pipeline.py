@@ -373,7 +373,7 @@ class ReconShell(cmd2.Cmd):
             )
 
         # store any tool installs/failures (back) to disk
-        pickle.dump(tools, persistent_tool_dict.open("wb"))
+        persistent_tool_dict.write_bytes(pickle.dumps(tools))
 
     @cmd2.with_argparser(status_parser)
     def do_status(self, args):
@@ -1,3 +1,4 @@
+import os
 import sys
 import inspect
 import pkgutil
@@ -66,3 +67,13 @@ def get_ip_address_version(ipaddr):
             return "4"
         elif isinstance(ipaddress.ip_address(ipaddr), ipaddress.IPv6Address):  # ipv6
             return "6"
+
+
+def get_nmap_xml_files(directory):
+    """ Simple helper that returns the nmap*.xml files in the given directory, sorted by name """
+    # scandir lets us check each name without building a Path for every .nmap/.gnmap file that gets skipped
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(Path(x.path) for x in entries if x.name.startswith("nmap") and x.name.endswith(".xml"))
+    except FileNotFoundError:
+        return list()
@@ -145,7 +145,7 @@ class MasscanScan(luigi.Task):
 
 @inherits(MasscanScan)
 class ParseMasscanOutput(luigi.Task):
-    """ Read masscan JSON results and create a pickled dictionary of pertinent information for processing.
+    """ Read masscan JSON results and add the open ports found for each target into the database.
 
     Args:
         top_ports: Scan top N most popular ports *Required by upstream Task*
@@ -184,23 +184,24 @@ class ParseMasscanOutput(luigi.Task):
     def output(self):
         """ Returns the target output for this task.
 
-        Naming convention for the output file is masscan.TARGET_FILE.parsed.pickle.
+        The output is the port table in the database, marked complete once masscan's results are recorded.
 
         Returns:
-            luigi.local_target.LocalTarget
+            luigi.contrib.sqla.SQLAlchemyTarget
         """
         return SQLAlchemyTarget(
             connection_string=self.db_mgr.connection_string, target_table="port", update_id=self.task_id
         )
 
     def run(self):
-        """ Reads masscan JSON results and creates a pickled dictionary of pertinent information for processing. """
+        """ Reads masscan JSON results and adds the open ports found for each target into the database. """
         try:
             # load masscan results from Masscan Task
-            entries = json.load(self.input().open())
+            with self.input().open() as f:
+                entries = json.load(f)
         except json.decoder.JSONDecodeError as e:
-            # return on exception; no output file created; pipeline should start again from
-            # this task if restarted because we never hit pickle.dump
+            # return on exception; no output marked complete; pipeline should start again from
+            # this task if restarted because we never hit self.output().touch()
             return print(e)
 
         self.results_subfolder.mkdir(parents=True, exist_ok=True)
@@ -1,19 +1,23 @@
-import ast
+import os
+import re
+import json
 import logging
+import functools
 import subprocess
 import concurrent.futures
 from pathlib import Path
+from collections import defaultdict
 
 import luigi
 import sqlalchemy
 from luigi.util import inherits
-from libnmap.parser import NmapParser
+from libnmap.parser import NmapParser, NmapParserException
 from luigi.contrib.sqla import SQLAlchemyTarget
 
 import pipeline.models.db_manager
 from .masscan import ParseMasscanOutput
 from .config import defaults, tool_paths
-from .helpers import get_ip_address_version, is_ip_address
+from .helpers import get_ip_address_version, is_ip_address, get_nmap_xml_files
 
 from ..models.port_model import Port
 from ..models.nse_model import NSEResult
@@ -22,11 +26,45 @@ from ..models.nmap_model import NmapResult
 from ..models.ip_address_model import IPAddress
 from ..models.searchsploit_model import SearchsploitResult
 
+# each JSON document printed by searchsploit -j begins and ends with a brace on a line of its own
+searchsploit_document_regex = re.compile(r"^{\s*$.*?^}\s*$", re.DOTALL | re.MULTILINE)
+
+
+def cache_output(output):
+    """ Decorator for a Task's output method; the targets are built on the first call and reused afterwards """
+
+    @functools.wraps(output)
+    def wrapper(self):
+        if self._output is None:
+            # a Task's parameters are fixed once it exists, so its targets never need to be rebuilt
+            self._output = output(self)
+        return self._output
+
+    return wrapper
+
+
+class LazyDatabaseMixin:
+    """ Shared by the nmap Tasks; opens the Task's database only once it's used and holds the cache_output targets """
+
+    _db_mgr = None
+    _output = None
+
+    @property
+    def db_mgr(self):
+        """ DBManager for this task; only opened once the task actually reads or writes results """
+        if self._db_mgr is None:
+            self._db_mgr = pipeline.models.db_manager.DBManager(db_location=self.db_location)
+        return self._db_mgr
+
 
 @inherits(ParseMasscanOutput)
-class ThreadedNmapScan(luigi.Task):
+class ThreadedNmapScan(LazyDatabaseMixin, luigi.Task):
     """ Run ``nmap`` against specific targets and ports gained from the ParseMasscanOutput Task.
 
+    Note:
+        When run as root, a target with both tcp and udp ports open is scanned by one ``nmap -sT -sU`` process whose
+        output files are named ``nmap.TARGET-tcp-udp.*``; otherwise each protocol gets its own scan.
+
     Install:
         ``nmap`` is already on your system if you're using kali.  If you're not using kali, refer to your own
         distributions instructions for installing ``nmap``.
@@ -56,7 +94,6 @@ class ThreadedNmapScan(luigi.Task):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.db_mgr = pipeline.models.db_manager.DBManager(db_location=self.db_location)
         self.results_subfolder = (Path(self.results_dir) / "nmap-results").expanduser().resolve()
 
     def requires(self):
@@ -79,6 +116,7 @@ class ThreadedNmapScan(luigi.Task):
         }
         return ParseMasscanOutput(**args)
 
+    @cache_output
     def output(self):
         """ Returns the target output for this task.
 
@@ -93,34 +131,66 @@ class ThreadedNmapScan(luigi.Task):
         """
         return {
             "sqltarget": SQLAlchemyTarget(
-                connection_string=self.db_mgr.connection_string, target_table="nmap_result", update_id=self.task_id
+                connection_string=pipeline.models.db_manager.DBManager.get_connection_string(self.db_location),
+                target_table="nmap_result",
+                update_id=self.task_id,
             ),
             "localtarget": luigi.LocalTarget(str(self.results_subfolder)),
         }
 
+    @staticmethod
+    def _parse_nmap_xml(entry):
+        """ Parse a single nmap .xml file, recovering what we can from files nmap never finished writing """
+        # relying on python-libnmap here
+        try:
+            return NmapParser.parse_fromfile(entry)
+        except NmapParserException:
+            # nmap was killed or aborted before closing its xml; each file is parsed on its own, so recover the
+            # hosts it did finish and move on instead of losing every file after this one
+            try:
+                return NmapParser.parse_fromfile(entry, incomplete=True)
+            except NmapParserException as e:
+                logging.error(f"Could not parse {entry}: {e}")
+
     def parse_nmap_output(self):
         """ Read nmap .xml results and add entries into specified database """
+        results_found = False
+
+        # loaded up front so that each host's ip address is a dict lookup rather than a query
+        ip_addresses = self.db_mgr.get_ip_addresses_by_address()
 
-        for entry in self.results_subfolder.glob("nmap*.xml"):
-            # relying on python-libnmap here
-            report = NmapParser.parse_fromfile(entry)
+        for entry in get_nmap_xml_files(self.results_subfolder):
+            report = self._parse_nmap_xml(entry)
+
+            if report is None:
+                continue
 
             for host in report.hosts:
-                for service in host.services:
-                    port = self.db_mgr.get_or_create(Port, protocol=service.protocol, port_number=service.port)
+                if not host.services:
+                    # nothing to record for this host; don't create ip/target records for it
+                    continue
+
+                # ip address and target are per-host; resolve them once instead of once per service
+                ip_address = ip_addresses.get(host.address)
 
+                if ip_address is None:
                     if is_ip_address(host.address) and get_ip_address_version(host.address) == "4":
-                        ip_address = self.db_mgr.get_or_create(IPAddress, ipv4_address=host.address)
+                        ip_address = IPAddress(ipv4_address=host.address)
                     else:
-                        ip_address = self.db_mgr.get_or_create(IPAddress, ipv6_address=host.address)
+                        ip_address = IPAddress(ipv6_address=host.address)
 
-                    if ip_address.target is None:
-                        # account for ip addresses identified that aren't already tied to a target
-                        # almost certainly ipv6 addresses
-                        tgt = self.db_mgr.get_or_create(Target)
-                        tgt.ip_addresses.append(ip_address)
-                    else:
-                        tgt = ip_address.target
+                    ip_addresses[host.address] = ip_address
+
+                if ip_address.target is None:
+                    # account for ip addresses identified that aren't already tied to a target
+                    # almost certainly ipv6 addresses
+                    tgt = self.db_mgr.get_or_create(Target)
+                    tgt.ip_addresses.append(ip_address)
+                else:
+                    tgt = ip_address.target
+
+                for service in host.services:
+                    port = self.db_mgr.get_or_create(Port, protocol=service.protocol, port_number=service.port)
 
                     try:
                         nmap_result = self.db_mgr.get_or_create(
@@ -128,13 +198,17 @@ class ThreadedNmapScan(luigi.Task):
                         )
                     except sqlalchemy.exc.StatementError:
                         # one of the three (port/ip/tgt) didn't exist and we're querying on ids that the db doesn't know
-                        self.db_mgr.add(port)
-                        self.db_mgr.add(ip_address)
-                        self.db_mgr.add(tgt)
+                        self.db_mgr.add(port, commit=False)
+                        self.db_mgr.add(ip_address, commit=False)
+                        self.db_mgr.add(tgt, commit=False)
                         nmap_result = self.db_mgr.get_or_create(
                             NmapResult, port=port, ip_address=ip_address, target=tgt
                         )
 
+                    # pending records are flushed (not committed) by later queries, so repeated ports/nse results
+                    # are still found by get_or_create while everything is committed in one transaction below
+                    self.db_mgr.add(nmap_result, commit=False)
+
                     for nse_result in service.scripts_results:
                         script_id = nse_result.get("id")
                         script_output = nse_result.get("output")
@@ -149,22 +223,23 @@ class ThreadedNmapScan(luigi.Task):
                     nmap_result.product_version = service.service_dict.get("version")
                     nmap_result.target.nmap_results.append(nmap_result)
 
-                    self.db_mgr.add(nmap_result)
-                    self.output().get("sqltarget").touch()
+                    results_found = True
+
+        if results_found:
+            self.db_mgr.commit()
+            self.output().get("sqltarget").touch()
 
         self.db_mgr.close()
 
-    def run(self):
-        """ Parses pickled target info dictionary and runs targeted nmap scans against only open ports. """
-        try:
-            self.threads = abs(int(self.threads))
-        except (TypeError, ValueError):
-            return logging.error("The value supplied to --threads must be a non-negative integer.")
+    def _build_nmap_command(self, target, scan_types, ports, suffix):
+        """ Build the nmap command for a single target; output files are named nmap.TARGET-SUFFIX.* """
+        # nmap needs -6 to scan an ipv6 address
+        ipv6 = ("-6",) if is_ip_address(target) and get_ip_address_version(target) == "6" else ()
 
-        nmap_command = [  # placeholders will be overwritten with appropriate info in loop below
+        return (
             "nmap",
             "--open",
-            "PLACEHOLDER-IDX-2",
+            *scan_types,
             "-n",
             "-sC",
             "-T",
@@ -172,43 +247,83 @@ class ThreadedNmapScan(luigi.Task):
             "-sV",
             "-Pn",
             "-p",
-            "PLACEHOLDER-IDX-10",
-            "-oA",
-        ]
-
-        commands = list()
+            ports,
+            *ipv6,
+            "-oA",  # arg to -oA, will drop into subdir off curdir
+            str(self.results_subfolder / f"nmap.{target}-{suffix}"),
+            target,  # target as final arg to nmap
+        )
 
-        for target in self.db_mgr.get_all_targets():
-            for protocol in ("tcp", "udp"):
-                ports = self.db_mgr.get_ports_by_ip_or_host_and_protocol(target, protocol)
-                if ports:
-                    tmp_cmd = nmap_command[:]
-                    tmp_cmd[2] = "-sT" if protocol == "tcp" else "-sU"
+    def run(self):
+        """ Grabs each target's open ports from the database and runs targeted nmap scans against only those ports. """
+        try:
+            self.threads = abs(int(self.threads))
+        except (TypeError, ValueError):
+            return logging.error("The value supplied to --threads must be a non-negative integer.")
 
-                    # arg to -oA, will drop into subdir off curdir
-                    tmp_cmd[10] = ",".join(ports)
-                    tmp_cmd.append(str(Path(self.output().get("localtarget").path) / f"nmap.{target}-{protocol}"))
+        # basically mkdir -p, won't error out if already there
+        self.results_subfolder.mkdir(parents=True, exist_ok=True)
 
-                    if is_ip_address(target) and get_ip_address_version(target) == "6":
-                        # got an ipv6 address
-                        tmp_cmd.insert(-2, "-6")
+        commands = list()
 
-                    tmp_cmd.append(target)  # target as final arg to nmap
+        # masscan commonly reports the same set of open ports for many targets; join each distinct set only once
+        joined_ports = dict()
 
-                    commands.append(tmp_cmd)
+        for target in self.db_mgr.get_all_targets():
+            scans = list()  # (protocol, scan type, joined ports) for each protocol with open ports
 
-        # basically mkdir -p, won't error out if already there
-        self.results_subfolder.mkdir(parents=True, exist_ok=True)
+            for protocol, scan_type in (("tcp", "-sT"), ("udp", "-sU")):
+                ports = self.db_mgr.get_ports_by_ip_or_host_and_protocol(target, protocol)
+                if ports:
+                    port_set = frozenset(ports)
+
+                    if port_set not in joined_ports:
+                        # numeric order gives identical sets an identical string, regardless of database order
+                        joined_ports[port_set] = ",".join(sorted(port_set, key=int))
+
+                    scans.append((protocol, scan_type, joined_ports[port_set]))
+
+            if len(scans) > 1 and os.geteuid() == 0:
+                # -sU requires root; only then can tcp and udp share one nmap process (and its startup cost)
+                commands.append(
+                    self._build_nmap_command(
+                        target,
+                        [scan_type for _, scan_type, _ in scans],
+                        ",".join(f"{protocol[0].upper()}:{ports}" for protocol, _, ports in scans),  # T:22,80,U:53
+                        "-".join(protocol for protocol, _, _ in scans),
+                    )
+                )
+            else:
+                # unprivileged, the udp scan fails on its own without costing us the tcp results
+                for protocol, scan_type, ports in scans:
+                    commands.append(self._build_nmap_command(target, [scan_type], ports, protocol))
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-
-            executor.map(subprocess.run, commands)
+            # results are read back from the -oA files; stderr is only kept to explain a failed scan
+            futures = {
+                executor.submit(subprocess.run, command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE): command
+                for command in commands
+            }
+
+            # consume each result so that failed scans are reported instead of silently discarded
+            for future in concurrent.futures.as_completed(futures):
+                command = " ".join(futures[future])
+
+                try:
+                    proc = future.result()
+                except OSError as e:
+                    logging.error(f"Could not run {command}: {e}")
+                    continue
+
+                if proc.returncode != 0:
+                    logging.warning(f"nmap exited with return code {proc.returncode}: {command}")
+                    logging.warning(proc.stderr.decode().strip())
 
         self.parse_nmap_output()
 
 
 @inherits(ThreadedNmapScan)
-class SearchsploitScan(luigi.Task):
+class SearchsploitScan(LazyDatabaseMixin, luigi.Task):
     """ Run ``searchcploit`` against each ``nmap*.xml`` file in the **TARGET-nmap-results** directory and write results to disk.
 
     Install:
@@ -226,7 +341,7 @@ class SearchsploitScan(luigi.Task):
             PYTHONPATH=$(pwd) luigi --local-scheduler --module recon.nmap Searchsploit --target-file htb-targets --top-ports 5000
 
     Args:
-        threads: number of threads for parallel nmap command execution *Required by upstream Task*
+        threads: number of threads for parallel nmap/searchsploit command execution *Required by upstream Task*
         db_location: specifies the path to the database used for storing results *Required by upstream Task*
         rate: desired rate for transmitting packets (packets per second) *Required by upstream Task*
         interface: use the named raw network interface, such as "eth0" *Required by upstream Task*
@@ -236,10 +351,6 @@ class SearchsploitScan(luigi.Task):
         results_dir: specifies the directory on disk to which all Task results are written *Required by upstream Task*
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.db_mgr = pipeline.models.db_manager.DBManager(db_location=self.db_location)
-
     def requires(self):
         """ Searchsploit depends on ThreadedNmap to run.
 
@@ -262,6 +373,7 @@ class SearchsploitScan(luigi.Task):
         }
         return ThreadedNmapScan(**args)
 
+    @cache_output
     def output(self):
         """ Returns the target output for this task.
 
@@ -274,51 +386,99 @@ class SearchsploitScan(luigi.Task):
             luigi.local_target.LocalTarget
         """
         return SQLAlchemyTarget(
-            connection_string=self.db_mgr.connection_string, target_table="searchsploit_result", update_id=self.task_id
+            connection_string=pipeline.models.db_manager.DBManager.get_connection_string(self.db_location),
+            target_table="searchsploit_result",
+            update_id=self.task_id,
         )
 
+    @staticmethod
+    def parse_searchsploit_output(contents):
+        """ Decode the JSON emitted by ``searchsploit -j`` and yield each exploit/shellcode result.
+
+        When run with ``--nmap``, searchsploit performs one search per service and prints a separate JSON document
+        for each of them, interleaved with verbose (non-JSON) output.  Each document is decoded in a single pass.
+
+        Args:
+            contents: decoded stdout from a ``searchsploit -j -v --nmap`` run
+
+        Returns:
+            generator of dict - one entry per result found in ``RESULTS_EXPLOIT`` and ``RESULTS_SHELLCODE``
+        """
+        for document in searchsploit_document_regex.findall(contents):
+            try:
+                payload = json.loads(document)
+            except json.JSONDecodeError:
+                # oddity introduced on 15 Apr 2020 from an exploitdb update
+                #   entries have two double quotes in a row for no apparent reason
+                #   {"Title":"PHP-FPM + Nginx - Remote Code Execution"", ...
+                #   only retried on failure so that legitimately empty strings survive
+                try:
+                    payload = json.loads(document.replace('""', '"'))
+                except json.JSONDecodeError as e:
+                    logging.error(f"Could not decode searchsploit output: {e}")
+                    continue
+
+            yield from payload.get("RESULTS_EXPLOIT", []) + payload.get("RESULTS_SHELLCODE", [])
+
+    def _wrapped_subprocess(self, entry):
+        """ Run searchsploit against a single nmap .xml file, returning the file along with searchsploit's stdout """
+        proc = subprocess.run(
+            [tool_paths.get("searchsploit"), "-j", "-v", "--nmap", str(entry)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return entry, proc.stdout
+
     def run(self):
         """ Grabs the xml files created by ThreadedNmap and runs searchsploit --nmap on each one, saving the output. """
-        for entry in Path(self.input().get("localtarget").path).glob("nmap*.xml"):
-            proc = subprocess.run(
-                [tool_paths.get("searchsploit"), "-j", "-v", "--nmap", str(entry)], stdout=subprocess.PIPE
-            )
-            if proc.stdout:
-                # change  wall-searchsploit-results/nmap.10.10.10.157-tcp to 10.10.10.157
+        try:
+            self.threads = abs(int(self.threads))
+        except (TypeError, ValueError):
+            return logging.error("The value supplied to --threads must be a non-negative integer.")
+
+        # searchsploit --nmap only searches on the products nmap identified; a file without any would still pay
+        # for a full searchsploit start (and exploit-db index load) just to return nothing
+        entries = [x for x in get_nmap_xml_files(self.input().get("localtarget").path) if 'product="' in x.read_text()]
+
+        # each searchsploit run is independent, but the database writes below stay on this thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            searchsploit_output = list(executor.map(self._wrapped_subprocess, entries))
+
+        results_by_ip = defaultdict(list)
+
+        for entry, stdout in searchsploit_output:
+            if stdout:
+                # change  wall-searchsploit-results/nmap.10.10.10.157-tcp-udp to 10.10.10.157
                 ipaddr = entry.stem.replace("nmap.", "").replace("-tcp", "").replace("-udp", "")
+                results_by_ip[ipaddr].extend(self.parse_searchsploit_output(stdout.decode()))
 
-                contents = proc.stdout.decode()
-                for line in contents.splitlines():
-                    if "Title" in line:
-                        # {'Title': "Nginx (Debian Based Distros + Gentoo) ... }
-
-                        # oddity introduced on 15 Apr 2020 from an exploitdb update
-                        #   entries have two double quotes in a row for no apparent reason
-                        #   {"Title":"PHP-FPM + Nginx - Remote Code Execution"", ...
-                        #   seems to affect all entries at the moment. will remove this line if it
-                        #   ever returns to normal
-                        line = line.replace('""', '"')
-
-                        if line.endswith(","):
-                            # result would be a tuple if the comma is left on the line; remove it
-                            tmp_result = ast.literal_eval(line.strip()[:-1])
-                        else:
-                            # normal dict
-                            tmp_result = ast.literal_eval(line.strip())
-
-                        tgt = self.db_mgr.get_or_create_target_by_ip_or_hostname(ipaddr)
-
-                        ssr_type = tmp_result.get("Type")
-                        ssr_title = tmp_result.get("Title")
-                        ssr_path = tmp_result.get("Path")
-
-                        ssr = self.db_mgr.get_or_create(
-                            SearchsploitResult, type=ssr_type, title=ssr_title, path=ssr_path
-                        )
+        ip_addresses = self.db_mgr.get_ip_addresses_by_address()
+
+        for ipaddr, results in results_by_ip.items():
+            if not results:
+                continue
+
+            # one target lookup per ip address, one commit overall
+            ip_address = ip_addresses.get(ipaddr)
+
+            if ip_address is not None and ip_address.target is not None:
+                tgt = ip_address.target
+            else:
+                tgt = self.db_mgr.get_or_create_target_by_ip_or_hostname(ipaddr)
+            self.db_mgr.add(tgt, commit=False)
+
+            for tmp_result in results:
+                # {"Title":"Nginx (Debian Based Distros + Gentoo) ... }
+                ssr_type = tmp_result.get("Type")
+                ssr_title = tmp_result.get("Title")
+                ssr_path = tmp_result.get("Path")
+
+                ssr = self.db_mgr.get_or_create(SearchsploitResult, type=ssr_type, title=ssr_title, path=ssr_path)
 
-                        tgt.searchsploit_results.append(ssr)
+                tgt.searchsploit_results.append(ssr)
 
-                        self.db_mgr.add(tgt)
-                        self.output().touch()
+        if any(results_by_ip.values()):
+            self.db_mgr.commit()
+            self.output().touch()
 
         self.db_mgr.close()
@@ -8,6 +8,7 @@ import pytest
 import pipeline.models.db_manager
 from pipeline.models.port_model import Port
 from pipeline.models.target_model import Target
+from pipeline.models.nmap_model import NmapResult
 from pipeline.models.ip_address_model import IPAddress
 
 
@@ -51,3 +52,29 @@ class TestDBManager:
         expectedset = set(expected)
         actual = self.db_mgr.get_ports_by_ip_or_host_and_protocol("dummy", test_input)
         assert set(actual) == expectedset
+
+    def test_add_without_commit(self):
+        tgt = self.create_temp_target()
+        self.db_mgr.add(tgt, commit=False)
+        assert tgt in self.db_mgr.session.new
+        self.db_mgr.commit()
+        assert "localhost" in self.db_mgr.get_all_hostnames()
+
+    def test_get_ip_addresses_by_address(self):
+        tgt = self.create_temp_target()
+        self.db_mgr.add(tgt)
+        ip_addresses = self.db_mgr.get_ip_addresses_by_address()
+        assert set(ip_addresses.keys()) == {"127.0.0.1", "::1"}
+        assert ip_addresses.get("127.0.0.1").target.hostname == "localhost"
+
+    def test_get_nmap_scans_by_ip_or_hostname(self):
+        for ipaddr in ("10.10.10.1", "10.10.10.15", "110.10.10.1"):
+            ip_address = IPAddress(ipv4_address=ipaddr)
+            tgt = Target(hostname=f"{ipaddr}.example.com", ip_addresses=[ip_address])
+            self.db_mgr.add(NmapResult(ip_address=ip_address, target=tgt, commandline=f"nmap -p 80 {ipaddr}"))
+
+        scans = self.db_mgr.get_nmap_scans_by_ip_or_hostname("10.10.10.1")
+        assert [x.ip_address.ipv4_address for x in scans] == ["10.10.10.1"]
+
+        scans = self.db_mgr.get_nmap_scans_by_ip_or_hostname("10.10.10.15.example.com")
+        assert [x.ip_address.ipv4_address for x in scans] == ["10.10.10.15"]
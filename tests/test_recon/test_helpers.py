@@ -1,6 +1,6 @@
 import pytest
 
-from pipeline.recon.helpers import get_ip_address_version, get_scans, is_ip_address
+from pipeline.recon.helpers import get_ip_address_version, get_scans, is_ip_address, get_nmap_xml_files
 
 
 def test_get_scans():
@@ -57,3 +57,11 @@ def test_is_ip_address(test_input, expected):
 )
 def test_get_ip_address_version(test_input, expected):
     assert get_ip_address_version(test_input) == expected
+
+
+def test_get_nmap_xml_files(tmp_path):
+    for name in ("nmap.b-tcp.xml", "nmap.a-tcp.xml", "nmap.a-tcp.nmap", "nmap.a-tcp.gnmap", "other.xml"):
+        (tmp_path / name).touch()
+
+    assert get_nmap_xml_files(tmp_path) == [tmp_path / "nmap.a-tcp.xml", tmp_path / "nmap.b-tcp.xml"]
+    assert get_nmap_xml_files(tmp_path / "missing") == list()
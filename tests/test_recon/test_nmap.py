@@ -1,5 +1,6 @@
 import shutil
 import tempfile
+import subprocess
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
@@ -28,7 +29,7 @@ class TestThreadedNmapScan:
             assert isinstance(retval, ParseMasscanOutput)
 
     def test_scan_run(self):
-        with patch("concurrent.futures.ThreadPoolExecutor.map") as mocked_run:
+        with patch("subprocess.run") as mocked_run:
             self.scan.parse_nmap_output = MagicMock()
             self.scan.db_mgr.get_all_targets = MagicMock()
             self.scan.db_mgr.get_all_targets.return_value = ["13.56.144.135", "2606:4700:10::6814:3c33"]
@@ -39,6 +40,83 @@ class TestThreadedNmapScan:
             assert mocked_run.called
             assert self.scan.parse_nmap_output.called
 
+    def test_scan_run_commands(self):
+        with patch("subprocess.run") as mocked_run, patch("os.geteuid", return_value=0):
+            self.scan.parse_nmap_output = MagicMock()
+            self.scan.db_mgr.get_all_targets = MagicMock(return_value=["13.56.144.135", "2606:4700:10::6814:3c33"])
+            self.scan.db_mgr.get_ports_by_ip_or_host_and_protocol = MagicMock(
+                side_effect=lambda target, protocol: ["135", "80"] if protocol == "tcp" or ":" not in target else []
+            )
+
+            self.scan.run()
+
+            ipv4_cmd, ipv6_cmd = sorted((x[0][0] for x in mocked_run.call_args_list), key=lambda x: "-6" in x)
+            assert ipv4_cmd == (
+                "nmap",
+                "--open",
+                "-sT",
+                "-sU",
+                "-n",
+                "-sC",
+                "-T",
+                "4",
+                "-sV",
+                "-Pn",
+                "-p",
+                "T:80,135,U:80,135",
+                "-oA",
+                str(self.tmp_path / "nmap-results" / "nmap.13.56.144.135-tcp-udp"),
+                "13.56.144.135",
+            )
+            assert "-sU" not in ipv6_cmd
+            assert ipv6_cmd[-6:] == (
+                "-p",
+                "80,135",
+                "-6",
+                "-oA",
+                str(self.tmp_path / "nmap-results" / "nmap.2606:4700:10::6814:3c33-tcp"),
+                "2606:4700:10::6814:3c33",
+            )
+
+    def test_scan_run_commands_without_root(self):
+        with patch("subprocess.run") as mocked_run, patch("os.geteuid", return_value=1000):
+            self.scan.parse_nmap_output = MagicMock()
+            self.scan.db_mgr.get_all_targets = MagicMock(return_value=["13.56.144.135"])
+            self.scan.db_mgr.get_ports_by_ip_or_host_and_protocol = MagicMock(return_value=["135", "80"])
+            # unprivileged -sU quits before scanning anything; the tcp scan must not depend on it
+            mocked_run.side_effect = lambda cmd, **kwargs: MagicMock(returncode=1 if "-sU" in cmd else 0, stderr=b"")
+
+            self.scan.run()
+
+            commands = sorted(x[0][0] for x in mocked_run.call_args_list)
+            assert len(commands) == 2
+            tcp_cmd, udp_cmd = commands
+            assert "-sT" in tcp_cmd and "-sU" not in tcp_cmd
+            assert tcp_cmd[-4:-2] == ("80,135", "-oA")
+            assert tcp_cmd[-2] == str(self.tmp_path / "nmap-results" / "nmap.13.56.144.135-tcp")
+            assert "-sU" in udp_cmd and "-sT" not in udp_cmd
+            assert udp_cmd[-2] == str(self.tmp_path / "nmap-results" / "nmap.13.56.144.135-udp")
+
+    def test_scan_run_reports_failures(self, caplog):
+        with patch("subprocess.run") as mocked_run:
+            self.scan.parse_nmap_output = MagicMock()
+            self.scan.db_mgr.get_all_targets = MagicMock(return_value=["13.56.144.135", "10.10.10.10"])
+            self.scan.db_mgr.get_ports_by_ip_or_host_and_protocol = MagicMock(
+                side_effect=lambda target, protocol: ["80"] if protocol == "tcp" else []
+            )
+            mocked_run.side_effect = lambda cmd, **kwargs: MagicMock(
+                returncode=1 if cmd[-1] == "10.10.10.10" else 0, stderr=b"Failed to resolve"
+            )
+
+            self.scan.run()
+
+            assert "nmap exited with return code 1" in caplog.text
+            assert "10.10.10.10" in caplog.text
+            assert "13.56.144.135" not in caplog.text
+            assert "Failed to resolve" in caplog.text
+            assert mocked_run.call_args[1] == {"stdout": subprocess.DEVNULL, "stderr": subprocess.PIPE}
+            assert self.scan.parse_nmap_output.called
+
     def test_scan_run_with_wrong_threads(self, caplog):
         with patch("concurrent.futures.ThreadPoolExecutor.map"):
             self.scan.threads = "a"
@@ -57,6 +135,20 @@ class TestThreadedNmapScan:
         assert "13.56.144.135" in self.scan.db_mgr.get_all_targets()
         assert "2606:4700:10::6814:3c33" in self.scan.db_mgr.get_all_targets()
 
+    def test_parse_nmap_output_with_truncated_xml(self, caplog):
+        (self.tmp_path / "nmap-results").mkdir(parents=True, exist_ok=True)
+        contents = (nmap_results / "nmap.13.56.144.135-tcp.xml").read_text()
+        truncated = contents[: contents.index("</host>") + len("</host>")]  # nmap killed before finishing the file
+        (self.scan.results_subfolder / "nmap.13.56.144.135-tcp.xml").write_text(truncated)
+        (self.scan.results_subfolder / "nmap.10.10.10.10-tcp.xml").write_text("<?xml version")
+        shutil.copy(nmap_results / "nmap.2606:4700:10::6814:3c33-tcp.xml", self.scan.results_subfolder)
+
+        self.scan.parse_nmap_output()
+
+        assert "Could not parse" in caplog.text
+        assert "13.56.144.135" in self.scan.db_mgr.get_all_targets()
+        assert "2606:4700:10::6814:3c33" in self.scan.db_mgr.get_all_targets()
+
     def test_scan_creates_results_dir(self):
         assert self.scan.results_subfolder == self.tmp_path / "nmap-results"
 
@@ -64,9 +156,16 @@ class TestThreadedNmapScan:
         assert self.scan.db_mgr.location.exists()
         assert self.tmp_path / "testing.sqlite" == self.scan.db_mgr.location
 
+    def test_scan_defers_database_creation(self):
+        self.scan.output()
+        assert not (self.tmp_path / "testing.sqlite").exists()
+
     def test_scan_output_location(self):
         assert self.scan.output().get("localtarget").path == str(self.tmp_path / "nmap-results")
 
+    def test_scan_output_is_reused(self):
+        assert self.scan.output() is self.scan.output()
+
 
 class TestSearchsploitScan:
     def setup_method(self):
@@ -86,6 +185,9 @@ class TestSearchsploitScan:
     def test_scan_output(self):
         retval = self.scan.output()
         assert isinstance(retval, SQLAlchemyTarget)
+        assert retval.connection_string == f"sqlite:///{self.tmp_path / 'testing.sqlite'}"
+        assert not (self.tmp_path / "testing.sqlite").exists()
+        assert retval is self.scan.output()
 
     def test_scan_creates_database(self):
         assert self.scan.db_mgr.location.exists()
@@ -107,3 +209,61 @@ class TestSearchsploitScan:
         self.scan.run()
 
         assert len(self.scan.db_mgr.get_all_searchsploit_results()) > 0
+
+    def test_parse_searchsploit_output(self):
+        contents = "\n".join(
+            [
+                "[i] SearchSploit's XML mode (verbose enabled).  To enable colour mode, run with --colour",
+                "{",
+                '\t"SEARCH": "nginx",',
+                '\t"DB_PATH_EXPLOIT": "/opt/exploitdb",',
+                '\t"RESULTS_EXPLOIT": [',
+                '\t\t{"Title":"Nginx 0.6.36 - Directory Traversal","EDB-ID":"12804","Type":"remote",'
+                '"Path":"/opt/exploitdb/exploits/multiple/remote/12804.txt"},',
+                '\t\t{"Title":"PHP-FPM + Nginx - Remote Code Execution","EDB-ID":"47553","Type":"webapps",'
+                '"Path":"/opt/exploitdb/exploits/php/webapps/47553.md"}',
+                "\t],",
+                '\t"DB_PATH_SHELLCODE": "/opt/exploitdb",',
+                '\t"RESULTS_SHELLCODE": [\t]',
+                "}",
+                "[i] /opt/exploitdb/searchsploit -t openssh 7.6p1",
+                "{",
+                '\t"SEARCH": "openssh 7.6p1",',
+                '\t"RESULTS_EXPLOIT": [',
+                '\t\t{"Title":"OpenSSH 7.7 - Username Enumeration"","Type":"remote",'
+                '"Path":"/opt/exploitdb/exploits/linux/remote/45233.py"}',
+                "\t],",
+                '\t"RESULTS_SHELLCODE": [\t]',
+                "}",
+            ]
+        )
+
+        results = list(self.scan.parse_searchsploit_output(contents))
+
+        assert [x.get("Title") for x in results] == [
+            "Nginx 0.6.36 - Directory Traversal",
+            "PHP-FPM + Nginx - Remote Code Execution",
+            "OpenSSH 7.7 - Username Enumeration",
+        ]
+        assert results[0].get("Type") == "remote"
+        assert results[1].get("Path") == "/opt/exploitdb/exploits/php/webapps/47553.md"
+
+    def test_scan_run_with_wrong_threads(self, caplog):
+        self.scan.threads = "a"
+        retval = self.scan.run()
+        assert retval is None
+        assert "The value supplied to --threads must be a non-negative integer" in caplog.text
+
+    def test_scan_run_dispatches_each_xml(self):
+        lcl_nmap = self.tmp_path / "nmap-results"
+        lcl_nmap.mkdir(parents=True, exist_ok=True)
+        shutil.copy(nmap_results / "nmap.13.56.144.135-tcp.xml", lcl_nmap)
+        shutil.copy(nmap_results / "nmap.2606:4700:10::6814:3c33-tcp.xml", lcl_nmap)
+        (lcl_nmap / "nmap.10.10.10.10-tcp.xml").write_text("<nmaprun><host><ports></ports></host></nmaprun>")
+
+        self.scan.input = lambda: {"localtarget": luigi.LocalTarget(lcl_nmap)}
+
+        with patch("subprocess.run") as mocked_run:
+            mocked_run.return_value = MagicMock(stdout=b"")
+            self.scan.run()
+            assert mocked_run.call_count == 2